@@ -2,12 +2,14 @@ import streamlit as st
 import pandas as pd
 import time
 import numpy as np
+from config import REFRESH_INTERVAL
 from fetch_data import fetch_latest_pm25
 from interpolate import interpolate_idw, interpolate_idw_point
 from visualize import create_map
 from streamlit_folium import st_folium
 import folium
 import json
+import base64
 
 # Predefined regions with bbox (min_lon, min_lat, max_lon, max_lat)
 REGIONS = {
@@ -18,7 +20,6 @@ REGIONS = {
 }
 
 # PM2.5 to AQI conversion (US EPA breakpoints)
-@st.cache_data
 def pm25_to_aqi(pm25):
     try:
         pm25 = float(pm25)
@@ -35,6 +36,29 @@ def pm25_to_aqi(pm25):
     except (ValueError, TypeError):
         return 0  # Fallback for invalid PM2.5 values
 
+# Breakpoint tables for the vectorized conversion: upper PM2.5 bound of each
+# category, then the AQI offset, PM2.5 low end and slope used inside it
+PM_BP = np.array([12, 35.4, 55.4, 150.4])
+AQI_OFF = np.array([0, 50, 100, 150])
+PM_LOW = np.array([0, 12.1, 35.5, 55.5])
+AQI_SLOPE = np.array([50 / 12, 50 / 23.4, 50 / 20, 50 / 95])
+
+# Vectorized pm25_to_aqi over an array of PM2.5 values
+def pm25_to_aqi_vec(pm25):
+    pm25 = np.asarray(pm25, dtype=float)
+    bins = np.searchsorted(PM_BP, pm25)  # First bin with pm25 <= upper bound
+    b = np.minimum(bins, len(PM_BP) - 1)
+    aqi = AQI_OFF[b] + AQI_SLOPE[b] * (pm25 - PM_LOW[b])
+    aqi = np.where(bins == len(PM_BP), 201, aqi)  # Simplified for >150.4
+    return aqi.astype(int)  # Truncates like int() in the scalar version
+
+# IDW grid cached on the station snapshot, so region switches and manual
+# refreshes within the TTL skip the interpolation (bbox is only part of the key)
+@st.cache_data(ttl=REFRESH_INTERVAL, max_entries=16, show_spinner=False)
+def _cached_idw(lon_tuple, lat_tuple, val_tuple, bbox, grid_resolution, power):
+    return interpolate_idw(np.array(lon_tuple), np.array(lat_tuple), np.array(val_tuple),
+                           grid_resolution=grid_resolution, power=power)
+
 # Get AQI alert message
 def get_aqi_alert(aqi):
     if aqi <= 50:
@@ -60,9 +84,6 @@ with st.sidebar:
     # Placeholder for legend
     legend_placeholder = st.empty()
 
-# Config
-REFRESH_INTERVAL = 300  # seconds
-
 # Dynamically adjust grid resolution based on bbox size
 lon_span = bbox[2] - bbox[0]
 lat_span = bbox[3] - bbox[1]
@@ -83,6 +104,7 @@ if 'last_update' not in st.session_state:
     st.session_state.grid_lon = None
     st.session_state.grid_lat = None
     st.session_state.grid_values = None
+    st.session_state.stats = None
 
 # Force refresh if region changes
 if st.session_state.selected_region != selected_region:
@@ -99,23 +121,73 @@ if time.time() - st.session_state.last_update > REFRESH_INTERVAL:
             if data.empty:
                 st.error(f"❌ No data available for {selected_region}. Check API key or station availability.")
             else:
+                # Station coordinates and values as contiguous arrays, reused below
+                lon = data['lon'].to_numpy(np.float64)
+                lat = data['lat'].to_numpy(np.float64)
+                val = data['value'].to_numpy(np.float64)
+
                 # Compute AQI for stations
-                data['aqi'] = data['value'].apply(pm25_to_aqi)
-                grid_lon, grid_lat, grid_pm25 = interpolate_idw(data, grid_resolution=grid_resolution, power=2.0)
+                data['aqi'] = pm25_to_aqi_vec(val)
+
+                # Summary stats for the Quick Stats panel, computed once per refresh
+                avg_aqi = float(data['aqi'].mean())
+                stats = {
+                    'avg_pm25': float(val.mean()),
+                    'avg_aqi': avg_aqi,
+                    'n': len(data),
+                    'alert': get_aqi_alert(avg_aqi),
+                }
+
+                grid_lon, grid_lat, grid_pm25 = _cached_idw(
+                    tuple(lon), tuple(lat), tuple(val),
+                    bbox, grid_resolution, 2.0
+                )
                 if grid_lon is None or np.all(np.isnan(grid_pm25)):
                     st.warning(f"⚠️ Insufficient data for interpolation in {selected_region} (fewer than 3 stations or invalid data). Showing station markers only.")
                 else:
                     st.success(f"✅ Interpolated PM2.5/AQI for {selected_region} using {len(data)} stations with IDW method.")
-                m, legend_html = create_map(grid_lon, grid_lat, grid_pm25, data, bbox)
+                m, legend_html = create_map(grid_lon, grid_lat, grid_pm25, lon, lat, val, data, bbox, grid_resolution)
                 
                 # Add custom click handler for non-station popups
                 if not data.empty:
-                    # Prepare data for JavaScript (only for non-station clicks)
-                    stations = data[['lon', 'lat', 'value']].to_dict('records')
+                    # Prepare data for JavaScript (only for non-station clicks): the
+                    # interpolated grid as base64 float32 (row-major, south to north)
+                    # plus the AQI breakpoint tables, shipped as a JSON blob
+                    grid = None
+                    if grid_lon is not None:
+                        grid = {
+                            'data': base64.b64encode(grid_pm25.astype('<f4').tobytes()).decode('ascii'),
+                            'nlat': grid_pm25.shape[0],
+                            'nlon': grid_pm25.shape[1],
+                            'lon0': float(grid_lon[0, 0]),
+                            'lat0': float(grid_lat[0, 0]),
+                            'res': grid_resolution,
+                        }
+                    click_data = {
+                        'grid': grid,
+                        'pm_bp': PM_BP.tolist(),
+                        'pm_low': PM_LOW.tolist(),
+                        'aqi_off': AQI_OFF.tolist(),
+                        'aqi_slope': AQI_SLOPE.tolist(),
+                        'aqi_breaks': [50, 100, 150],
+                        'alerts': [get_aqi_alert(aqi) for aqi in (50, 100, 150, 151)],
+                    }
                     js_code = """
                     <script>
                     function addClickHandler(map) {
                         try {
+                            var cfg = JSON.parse(document.getElementById('click-data').textContent);
+                            var grid = null;
+                            if (cfg.grid) {
+                                var bytes = Uint8Array.from(atob(cfg.grid.data), function(c) { return c.charCodeAt(0); });
+                                grid = new Float32Array(bytes.buffer);
+                            }
+                            // Index of the first bound >= x (bounds.length if above all)
+                            function category(x, bounds) {
+                                var b = 0;
+                                while (b < bounds.length && x > bounds[b]) b++;
+                                return b;
+                            }
                             map.on('click', function(e) {
                                 // Check if click is on a marker (skip if true to allow marker popups)
                                 if (e.originalEvent.target.className.includes('marker')) {
@@ -123,43 +195,20 @@ if time.time() - st.session_state.last_update > REFRESH_INTERVAL:
                                 }
                                 var lat = e.latlng.lat;
                                 var lng = e.latlng.lng;
-                                var stations = %s;
-                                var power = 2.0;
-                                var sum_weights = 0;
-                                var sum_weighted_values = 0;
-                                for (var i = 0; i < stations.length; i++) {
-                                    var dist = Math.sqrt(
-                                        Math.pow(stations[i].lon - lng, 2) +
-                                        Math.pow(stations[i].lat - lat, 2)
-                                    );
-                                    if (dist === 0) dist = Number.EPSILON;
-                                    var weight = 1 / Math.pow(dist, power);
-                                    sum_weights += weight;
-                                    sum_weighted_values += weight * stations[i].value;
-                                }
-                                var pm25 = sum_weighted_values / sum_weights;
-                                var aqi;
-                                if (pm25 <= 12) {
-                                    aqi = Math.round((50 / 12) * pm25);
-                                } else if (pm25 <= 35.4) {
-                                    aqi = Math.round(50 + (50 / 23.4) * (pm25 - 12.1));
-                                } else if (pm25 <= 55.4) {
-                                    aqi = Math.round(100 + (50 / 20) * (pm25 - 35.5));
-                                } else if (pm25 <= 150.4) {
-                                    aqi = Math.round(150 + (50 / 95) * (pm25 - 55.5));
-                                } else {
-                                    aqi = 201;
-                                }
-                                var alert;
-                                if (aqi <= 50) {
-                                    alert = "🟢 Good: Air quality is satisfactory. No health risks.";
-                                } else if (aqi <= 100) {
-                                    alert = "🟡 Moderate: Air quality acceptable. Sensitive groups may notice minor effects.";
-                                } else if (aqi <= 150) {
-                                    alert = "🟠 Unhealthy for Sensitive: Reduce outdoor activity for children, elderly, and those with respiratory issues.";
-                                } else {
-                                    alert = "🔴 Unhealthy: Potential health effects for everyone. Limit outdoor time.";
+                                // Look up the nearest cell of the server-side IDW grid
+                                var pm25 = NaN;
+                                if (grid) {
+                                    var i = Math.round((lat - cfg.grid.lat0) / cfg.grid.res);
+                                    var j = Math.round((lng - cfg.grid.lon0) / cfg.grid.res);
+                                    if (i >= 0 && i < cfg.grid.nlat && j >= 0 && j < cfg.grid.nlon) {
+                                        pm25 = grid[i * cfg.grid.nlon + j];
+                                    }
                                 }
+                                var b = category(pm25, cfg.pm_bp);
+                                var aqi = b < cfg.pm_bp.length
+                                    ? Math.round(cfg.aqi_off[b] + cfg.aqi_slope[b] * (pm25 - cfg.pm_low[b]))
+                                    : 201;
+                                var alert = cfg.alerts[category(aqi, cfg.aqi_breaks)];
                                 var content;
                                 if (isNaN(pm25)) {
                                     content = '<div style="font-size: 12px; padding: 5px;">' +
@@ -186,12 +235,15 @@ if time.time() - st.session_state.last_update > REFRESH_INTERVAL:
                         }
                     }
                     </script>
-                    """ % json.dumps(stations)
+                    """
+                    data_blob = '<script id="click-data" type="application/json">' + json.dumps(click_data) + '</script>'
+                    m.get_root().html.add_child(folium.Element(data_blob))
                     m.get_root().html.add_child(folium.Element(js_code))
                     m.get_root().html.add_child(folium.Element("<script>document.addEventListener('DOMContentLoaded', function() { try { addClickHandler(map); } catch (err) { console.error('Error initializing click handler: ' + err.message); } });</script>"))
                 
                 st.session_state.map = m
                 st.session_state.data = data
+                st.session_state.stats = stats
                 st.session_state.grid_lon = grid_lon
                 st.session_state.grid_lat = grid_lat
                 st.session_state.grid_values = grid_pm25
@@ -206,18 +258,23 @@ if legend_html:
         st.markdown("**AQI Levels & Effects**")
         st.markdown(legend_html, unsafe_allow_html=True)
 
+# Map interactions rerun only this fragment instead of the whole script
+@st.fragment
+def render_map():
+    st_folium(
+        st.session_state.map,
+        width=700,
+        height=500,
+        returned_objects=[]
+    )
+
 # Layout: Columns for map and data
 col1, col2 = st.columns([7, 3])
 
 with col1:
     st.subheader("🗺️ Interactive Air Quality Map")
     if st.session_state.map:
-        st_folium(
-            st.session_state.map,
-            width=700,
-            height=500,
-            returned_objects=[]
-        )
+        render_map()
     else:
         st.info("🗺️ Select a region to load the map.")
     
@@ -227,17 +284,14 @@ with col1:
 
 with col2:
     st.subheader("📊 Quick Stats")
-    if not st.session_state.data.empty:
-        avg_pm25 = st.session_state.data['value'].mean()
-        avg_aqi = st.session_state.data['aqi'].mean()
-        num_stations = len(st.session_state.data)
-        st.metric("Avg PM2.5 (µg/m³)", f"{avg_pm25:.1f}", delta=None)
-        st.metric("Avg AQI", f"{avg_aqi:.0f}", delta=None)
-        st.metric("Stations", num_stations, delta=None)
+    stats = st.session_state.stats
+    if stats:
+        st.metric("Avg PM2.5 (µg/m³)", f"{stats['avg_pm25']:.1f}", delta=None)
+        st.metric("Avg AQI", f"{stats['avg_aqi']:.0f}", delta=None)
+        st.metric("Stations", stats['n'], delta=None)
         
         # Overall average AQI message
-        avg_alert = get_aqi_alert(avg_aqi)
-        st.markdown(f"**Overall Alert**: {avg_alert}")
+        st.markdown(f"**Overall Alert**: {stats['alert']}")
         
         with st.expander("🔍 Detailed Station Data (Current from OpenAQ)"):
             st.dataframe(st.session_state.data[['lat', 'lon', 'value', 'aqi', 'datetime']].round(2), use_container_width=True)
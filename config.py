@@ -0,0 +1,2 @@
+# Shared app settings
+REFRESH_INTERVAL = 300  # seconds
@@ -1,6 +1,12 @@
-import requests
+import asyncio
+import threading
+import httpx
+import backoff
+from ratelimit import limits, RateLimitException
 import pandas as pd
+import streamlit as st
 from dotenv import load_dotenv
+from config import REFRESH_INTERVAL
 import os
 
 # Load API key
@@ -10,27 +16,77 @@ if not API_KEY:
     raise ValueError("API key not found in .env file")
 
 PARAMETER_ID = '2'  # PM2.5
-LIMIT = 1000  # Max results
+LIMIT = 1000  # Max results per page
+PAGES = 1  # Pages fetched concurrently
 BASE_URL = 'https://api.openaq.org/v3'
+RATE_LIMIT_CALLS = 60  # OpenAQ allows 60 requests per minute
+RATE_LIMIT_PERIOD = 60  # seconds
 
-def fetch_latest_pm25(bbox=None):
+@limits(calls=RATE_LIMIT_CALLS, period=RATE_LIMIT_PERIOD)
+def _check_rate_limit():
+    pass  # Raises RateLimitException once the per-minute budget is spent; not retried
+
+def _is_client_error(e):
+    # Don't retry 4xx responses (bad API key, bad request) other than 429
+    return (isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500
+            and e.response.status_code != 429)
+
+@backoff.on_exception(backoff.expo, httpx.HTTPError, max_tries=3, giveup=_is_client_error)
+async def _fetch_page(client, page):
+    _check_rate_limit()
+    url = f'{BASE_URL}/parameters/{PARAMETER_ID}/latest'
+    response = await client.get(url, params={'limit': LIMIT, 'page': page})
+    response.raise_for_status()
+    return response.json()
+
+async def _fetch_pages(client, pages):
+    return await asyncio.gather(*[_fetch_page(client, p) for p in range(1, pages + 1)])
+
+# Long-lived event loop in a daemon thread. The pooled client below keeps its
+# connections bound to the loop that opened them, so every fetch runs here.
+@st.cache_resource
+def _get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# One client per server process: TCP/TLS connections are reused across reruns
+@st.cache_resource
+def get_client():
+    headers = {'X-API-Key': API_KEY}
+    pool_limits = httpx.Limits(max_connections=16, max_keepalive_connections=4)
+    return httpx.AsyncClient(http2=True, headers=headers, timeout=10, limits=pool_limits)
+
+def _parse_results(data):
+    if 'results' not in data or not data['results']:
+        return pd.DataFrame(columns=['lat', 'lon', 'value', 'datetime'])
+
+    # Flatten coordinates and datetime in one pass, then keep lat, lon, value, datetime
+    df = pd.json_normalize(data['results'], sep='_')
+    # Rows with a null coordinates/datetime keep the raw column; drop it so the
+    # renames below can't create duplicate labels (those rows become NaN)
+    df = df.drop(columns=['coordinates', 'datetime'], errors='ignore')
+    df = df.rename(columns={'coordinates_latitude': 'lat', 'coordinates_longitude': 'lon',
+                            'datetime_utc': 'datetime'})
+    df = df.reindex(columns=['lat', 'lon', 'value', 'datetime'])
+    df['value'] = pd.to_numeric(df['value'], errors='coerce')
+    return df.dropna()
+
+# The endpoint is global (the bbox is applied client-side), so one cached fetch
+# per refresh interval serves every region. Errors raise and are not cached.
+@st.cache_data(ttl=REFRESH_INTERVAL, show_spinner=False)
+def _fetch_all(pages=PAGES):
+    # All pages are requested concurrently over the shared HTTP/2 connection
+    future = asyncio.run_coroutine_threadsafe(_fetch_pages(get_client(), pages), _get_event_loop())
+    frames = [_parse_results(data) for data in future.result()]
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=['lat', 'lon', 'value', 'datetime'])
+    return pd.concat(frames, ignore_index=True)
+
+def fetch_latest_pm25(bbox=None, pages=PAGES):
     try:
-        url = f'{BASE_URL}/parameters/{PARAMETER_ID}/latest?limit={LIMIT}'
-        headers = {'X-API-Key': API_KEY}
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-        if 'results' not in data or not data['results']:
-            return pd.DataFrame(columns=['lat', 'lon', 'value', 'datetime'])
-
-        df = pd.DataFrame(data['results'])
-        # Extract coordinates, value, datetime
-        df['lat'] = df['coordinates'].apply(lambda x: x['latitude'] if isinstance(x, dict) else None)
-        df['lon'] = df['coordinates'].apply(lambda x: x['longitude'] if isinstance(x, dict) else None)
-        df['datetime'] = df['datetime'].apply(lambda x: x['utc'] if isinstance(x, dict) else None)
-        df['value'] = df['value'].apply(lambda x: x if isinstance(x, (int, float)) else None)
-        df = df[['lat', 'lon', 'value', 'datetime']].dropna()
+        df = _fetch_all(pages)
 
         # Filter by bbox if provided
         if bbox:
@@ -40,7 +96,7 @@ def fetch_latest_pm25(bbox=None):
         
         return df
 
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, RateLimitException) as e:
         print(f"Error fetching data: {e}")
         return pd.DataFrame(columns=['lat', 'lon', 'value', 'datetime'])
 
@@ -1,79 +1,125 @@
 from scipy.interpolate import griddata
+from scipy.spatial import cKDTree
 import numpy as np
 import pandas as pd
+from numba import config, njit, prange
 
-def interpolate_idw(data, grid_resolution=0.05, power=2.0):
+# Streamlit runs scripts off the main thread; the TBB layer hangs interpreter exit
+# when first launched from such a thread, so prefer thread-safe OpenMP
+config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+
+IDW_NEIGHBORS = 8  # Stations used per query point; farther weights are negligible
+
+@njit(inline='always', fastmath=True, cache=True)
+def _idw_weight(d, power):
+    # Fast paths for the common powers; a general pow() costs far more than a
+    # multiply, and the branch is loop-invariant in the kernel
+    if power == 2.0:
+        return 1.0 / (d * d)
+    elif power == 1.0:
+        return 1.0 / d
+    return d ** (-power)
+
+def _idw_weights(dists, power):
+    # Vectorized counterpart of _idw_weight for the NumPy point queries
+    if power == 2.0:
+        return 1.0 / (dists * dists)
+    elif power == 1.0:
+        return 1.0 / dists
+    return dists ** (-power)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _idw_kernel(dists, idx, vals, power, out):
+    # One fused pass per grid cell over its k nearest stations: weight and
+    # weighted sum are accumulated as scalars, with no temporaries allocated
+    eps = np.finfo(np.float64).eps
+    for i in prange(dists.shape[0]):
+        sw = 0.0
+        swv = 0.0
+        for j in range(dists.shape[1]):
+            d = dists[i, j]
+            if d < eps:
+                d = eps
+            w = _idw_weight(d, power)
+            sw += w
+            swv += w * vals[idx[i, j]]
+        out[i] = swv / sw
+
+def _nearest_stations(points, query, k=IDW_NEIGHBORS):
+    # k nearest stations for each query point as (dists, idx), each (n_query, k)
+    tree = cKDTree(points)
+    return tree.query(query, k=min(k, len(points)), workers=-1)
+
+def interpolate_idw(lon, lat, values, grid_resolution=0.05, power=2.0):
     """
-    Perform Inverse Distance Weighting (IDW) interpolation for PM2.5 values.
+    Perform Inverse Distance Weighting (IDW) interpolation for PM2.5 values,
+    using only the IDW_NEIGHBORS nearest stations for each grid cell.
     
     Parameters:
-    - data: pd.DataFrame with columns 'lon', 'lat', 'value'
+    - lon, lat, values: 1D float64 arrays of station coordinates and PM2.5
     - grid_resolution: float, spacing for the output grid
     - power: float, power parameter for IDW (higher = more local influence)
     
     Returns:
-    - grid_lon, grid_lat: 2D meshes
-    - grid_values: 2D array of interpolated values (NaN outside influence)
+    - grid_lon, grid_lat: (1, nlon) and (nlat, 1) views that broadcast to the grid
+    - grid_values: 2D float32 array of interpolated values (NaN outside influence)
     """
-    if data.empty or len(data) < 3:  # Skip interpolation if < 3 points
+    if len(values) < 3:  # Skip interpolation if < 3 points
         print("Warning: Fewer than 3 stations; skipping interpolation.")
         return None, None, None
     
     # Create grid slightly larger than data extent
-    lon_min, lon_max = data['lon'].min() - 0.1, data['lon'].max() + 0.1
-    lat_min, lat_max = data['lat'].min() - 0.1, data['lat'].max() + 0.1
-    lons = np.arange(lon_min, lon_max, grid_resolution)
-    lats = np.arange(lat_min, lat_max, grid_resolution)
-    grid_lon, grid_lat = np.meshgrid(lons, lats)
-
-    # Station points and values
-    points = data[['lon', 'lat']].values  # (n_stations, 2): [lon, lat]
-    values = data['value'].values
+    lon_min, lon_max = lon.min() - 0.1, lon.max() + 0.1
+    lat_min, lat_max = lat.min() - 0.1, lat.max() + 0.1
+    # float32 is ample for PM2.5 and halves grid memory traffic; the axes are
+    # stepped in float64 first so rounding doesn't accumulate along them
+    lons = np.arange(lon_min, lon_max, grid_resolution).astype(np.float32)
+    lats = np.arange(lat_min, lat_max, grid_resolution).astype(np.float32)
+    grid_lon, grid_lat = lons[None, :], lats[:, None]
+    shape = (lats.size, lons.size)
 
-    # Initialize grid with NaN
-    grid_values = np.full_like(grid_lon, np.nan)
+    # Station points
+    points = np.column_stack((lon, lat)).astype(np.float32)  # (n_stations, 2): [lon, lat]
+    values = np.ascontiguousarray(values, dtype=np.float32)
 
-    # IDW interpolation for each grid point
-    for i in range(grid_lat.shape[0]):
-        for j in range(grid_lon.shape[1]):
-            query_lon = grid_lon[i, j]
-            query_lat = grid_lat[i, j]
-            
-            # Compute distances (in degrees, approximate for small areas)
-            dists = np.sqrt((points[:, 0] - query_lon)**2 + (points[:, 1] - query_lat)**2)
-            
-            # Avoid division by zero (exact station location)
-            dists[dists == 0] = np.finfo(float).eps
-            
-            # Weights: 1 / dist^power
-            weights = 1.0 / (dists ** power)
-            
-            # Weighted average
-            grid_values[i, j] = np.sum(weights * values) / np.sum(weights)
+    # Distances are in degrees, approximate for small areas
+    # cKDTree needs explicit query points, so this is the only place the full
+    # grid of coordinates is materialized
+    query = np.column_stack((np.broadcast_to(grid_lon, shape).ravel(),
+                             np.broadcast_to(grid_lat, shape).ravel()))
+    dists, idx = _nearest_stations(points, query)
+    grid_flat = np.empty(query.shape[0], dtype=np.float32)
+    _idw_kernel(dists, idx, values, float(power), grid_flat)
+    grid_values = grid_flat.reshape(shape)
 
     return grid_lon, grid_lat, grid_values
 
-def interpolate_idw_point(data, query_lon, query_lat, power=2.0):
+def interpolate_idw_point(lon, lat, values, query_lon, query_lat, power=2.0):
     """
-    Perform IDW interpolation for a single point.
+    Perform IDW interpolation for one or many points, each from its
+    IDW_NEIGHBORS nearest stations.
     
     Parameters:
-    - data: pd.DataFrame with columns 'lon', 'lat', 'value'
-    - query_lon, query_lat: coordinates of the point to interpolate
+    - lon, lat, values: 1D float64 arrays of station coordinates and PM2.5
+    - query_lon, query_lat: scalars or 1D arrays of the points to interpolate
     - power: float, power parameter for IDW
     
     Returns:
-    - interpolated_value: float or NaN if insufficient data
+    - interpolated_value: float for scalar queries, else a 1D array; NaN if
+      insufficient data
     """
-    if data.empty or len(data) < 3:
-        return np.nan
+    scalar = np.ndim(query_lon) == 0 and np.ndim(query_lat) == 0
+    query_lon, query_lat = np.broadcast_arrays(np.atleast_1d(query_lon), np.atleast_1d(query_lat))
+    if len(values) < 3:
+        return np.nan if scalar else np.full(query_lon.shape, np.nan)
     
-    points = data[['lon', 'lat']].values
-    values = data['value'].values
+    points = np.column_stack((lon, lat))
+    values = np.asarray(values)
     
-    dists = np.sqrt((points[:, 0] - query_lon)**2 + (points[:, 1] - query_lat)**2)
+    # All queries go through one batched tree lookup: (n_query, k) neighbours
+    dists, idx = _nearest_stations(points, np.column_stack((query_lon, query_lat)))
     dists[dists == 0] = np.finfo(float).eps
-    weights = 1.0 / (dists ** power)
-    interpolated_value = np.sum(weights * values) / np.sum(weights)
+    weights = _idw_weights(dists, power)
+    interpolated_value = np.sum(weights * values[idx], axis=1) / np.sum(weights, axis=1)
     
-    return interpolated_value
\ No newline at end of file
+    return interpolated_value[0] if scalar else interpolated_value
@@ -1,11 +1,94 @@
 import folium
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+import pandas as pd
+from PIL import Image
 from io import BytesIO
 import base64
+import streamlit as st
+from config import REFRESH_INTERVAL
 
-def create_map(grid_lon, grid_lat, grid_values, data, bbox, center=None):
+# RGBA per AQI category (green, yellow, orange, red at 60% alpha), plus a fully
+# transparent entry for cells with no data
+PALETTE = np.array([
+    [0, 128, 0, 153],
+    [255, 255, 0, 153],
+    [255, 165, 0, 153],
+    [255, 0, 0, 153],
+    [0, 0, 0, 0],
+], dtype=np.uint8)
+
+# The overlay is cached on the raw grid bytes (hashable) and the PM2.5 levels
+@st.cache_data(ttl=REFRESH_INTERVAL, max_entries=8, show_spinner=False)
+def _render_overlay_png(grid_values_bytes, shape, levels_tuple):
+    grid_values = np.frombuffer(grid_values_bytes, dtype=np.float32).reshape(shape)
+
+    # Color each grid cell by its AQI category directly, one pixel per cell
+    bins = np.digitize(grid_values, levels_tuple[1:])
+    nodata = np.isnan(grid_values) | (grid_values < levels_tuple[0])
+    rgba = PALETTE[np.where(nodata, len(PALETTE) - 1, bins)]
+
+    # Grid rows run south to north, image rows top to bottom
+    buf = BytesIO()
+    Image.fromarray(rgba[::-1]).save(buf, 'PNG', optimize=False)
+    img_data = base64.b64encode(buf.getvalue()).decode('utf-8')
+
+    return f'data:image/png;base64,{img_data}'
+
+# AQI category upper bounds, with the marker color and alert text per category
+AQI_BREAKS = [50, 100, 150]
+AQI_COLORS = np.array(['green', 'yellow', 'orange', 'red'])
+AQI_ALERTS = np.array([
+    "🟢 Good: Air quality is satisfactory. No health risks.",
+    "🟡 Moderate: Air quality acceptable. Sensitive groups may notice minor effects.",
+    "🟠 Unhealthy for Sensitive: Reduce outdoor activity for children, elderly, and those with respiratory issues.",
+    "🔴 Unhealthy: Potential health effects for everyone. Limit outdoor time.",
+])
+
+def _add_station_markers(m, lon, lat, val, aqi, datetime_col, names):
+    # Station markers with detailed popups
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    val = np.asarray(val, dtype=np.float64)
+    aqi = np.asarray(aqi)
+    category = np.searchsorted(AQI_BREAKS, aqi)
+
+    # Build every popup at once with vectorized string ops
+    popups = ('<div style="font-size: 12px; padding: 5px; width: 200px;">'
+              + '<b>Station: ' + pd.Series(names, dtype=str) + '</b><br>'
+              + '<b>AQI: ' + pd.Series(aqi).astype(str) + '</b><br>'
+              + 'PM2.5: ' + pd.Series(np.char.mod('%.1f', val)) + ' µg/m³<br>'
+              + pd.Series(AQI_ALERTS[category]) + '<br>'
+              + 'Lat: ' + pd.Series(np.char.mod('%.3f', lat)) + '<br>'
+              + 'Lon: ' + pd.Series(np.char.mod('%.3f', lon)) + '<br>'
+              + 'Time: ' + pd.Series(datetime_col, dtype=str) + '<br>'
+              + '</div>')
+
+    # One GeoJSON layer for all stations: a single payload and Leaflet layer
+    # instead of a script block per marker. The feature ids key folium's styler,
+    # which would otherwise switch on (and repeat) a unique property like popup
+    features = [
+        {
+            'type': 'Feature',
+            'id': str(i),
+            'geometry': {'type': 'Point', 'coordinates': [lo, la]},
+            'properties': {'aqi': a, 'color': color, 'popup': popup},
+        }
+        for i, (lo, la, a, color, popup) in enumerate(zip(lon.tolist(), lat.tolist(), aqi.tolist(),
+                                                          AQI_COLORS[category].tolist(), popups))
+    ]
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name='Stations',
+        style_function=lambda feature: {
+            'color': feature['properties']['color'],
+            'fillColor': feature['properties']['color'],
+            'fillOpacity': 0.8,
+        },
+        marker=folium.CircleMarker(radius=6, fill=True),
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False, max_width=200),
+    ).add_to(m)
+
+def create_map(grid_lon, grid_lat, grid_values, lon, lat, val, data, bbox, grid_resolution, center=None):
     # Define legend HTML with dynamic sizing
     legend_html = '''
     <div style="background-color: white; border: 2px solid grey; 
@@ -20,6 +103,14 @@ def create_map(grid_lon, grid_lat, grid_values, data, bbox, center=None):
     </div>
     '''
     
+    # Display-only station columns
+    aqi = data['aqi'].to_numpy() if 'aqi' in data else np.zeros(len(data), dtype=int)
+    names = data['station_name'].to_numpy() if 'station_name' in data else ['Unknown Station'] * len(data)
+    times = data['datetime'].to_numpy() if 'datetime' in data else ['Unknown Time'] * len(data)
+
+    # Fit to bbox
+    bounds = [[bbox[1], bbox[0]], [bbox[3], bbox[2]]]
+
     # Default map if no data or insufficient points for interpolation
     if data.empty or grid_lon is None or grid_values is None or np.all(np.isnan(grid_values)):
         m = folium.Map(location=[27.7, 85.3], zoom_start=7, tiles='OpenStreetMap')  # Center on Kathmandu
@@ -27,183 +118,46 @@ def create_map(grid_lon, grid_lat, grid_values, data, bbox, center=None):
             folium.Marker([27.7, 85.3], popup="No data available").add_to(m)
         else:
             # Add markers for available stations with detailed popups
-            def get_color(aqi):
-                if aqi <= 50: return 'green'
-                elif aqi <= 100: return 'yellow'
-                elif aqi <= 150: return 'orange'
-                else: return 'red'
-
-            def get_alert(aqi):
-                if aqi <= 50:
-                    return "🟢 Good: Air quality is satisfactory. No health risks."
-                elif aqi <= 100:
-                    return "🟡 Moderate: Air quality acceptable. Sensitive groups may notice minor effects."
-                elif aqi <= 150:
-                    return "🟠 Unhealthy for Sensitive: Reduce outdoor activity for children, elderly, and those with respiratory issues."
-                else:
-                    return "🔴 Unhealthy: Potential health effects for everyone. Limit outdoor time."
-
-            for _, row in data.iterrows():
-                aqi = row.get('aqi', 0)
-                pm25 = row.get('value', 0)
-                station_name = row.get('station_name', 'Unknown Station')
-                timestamp = row.get('datetime', 'Unknown Time')
-                popup_content = f"""
-                <div style="font-size: 12px; padding: 5px; width: 200px;">
-                    <b>Station: {station_name}</b><br>
-                    <b>AQI: {aqi}</b><br>
-                    PM2.5: {pm25:.1f} µg/m³<br>
-                    {get_alert(aqi)}<br>
-                    Lat: {row['lat']:.3f}<br>
-                    Lon: {row['lon']:.3f}<br>
-                    Time: {timestamp}<br>
-                </div>
-                """
-                folium.CircleMarker(
-                    location=[float(row['lat']), float(row['lon'])],
-                    radius=6, 
-                    color=get_color(aqi), 
-                    fill=True, 
-                    fillOpacity=0.8,
-                    popup=folium.Popup(popup_content, max_width=200)
-                ).add_to(m)
-        # Fit to bbox
-        bounds = [[bbox[1], bbox[0]], [bbox[3], bbox[2]]]
+            _add_station_markers(m, lon, lat, val, aqi, times, names)
         m.fit_bounds(bounds)
         
         return m, legend_html
 
     # Normal case with interpolation: Create smooth colored overlay
     if center is None:
-        center = [grid_lat.mean(), grid_lon.mean()]
+        center = [float(grid_lat.mean()), float(grid_lon.mean())]
 
     m = folium.Map(location=center, zoom_start=7, tiles='OpenStreetMap')
 
-    # Validate grid_values for contour plotting
+    # Validate grid_values for the overlay
     valid_values = grid_values[~np.isnan(grid_values)]
     if len(valid_values) == 0:
         # No valid interpolated data; fallback to markers
-        def get_color(aqi):
-            if aqi <= 50: return 'green'
-            elif aqi <= 100: return 'yellow'
-            elif aqi <= 150: return 'orange'
-            else: return 'red'
-
-        def get_alert(aqi):
-            if aqi <= 50:
-                return "🟢 Good: Air quality is satisfactory. No health risks."
-            elif aqi <= 100:
-                return "🟡 Moderate: Air quality acceptable. Sensitive groups may notice minor effects."
-            elif aqi <= 150:
-                return "🟠 Unhealthy for Sensitive: Reduce outdoor activity for children, elderly, and those with respiratory issues."
-            else:
-                return "🔴 Unhealthy: Potential health effects for everyone. Limit outdoor time."
-
-        for _, row in data.iterrows():
-            aqi = row.get('aqi', 0)
-            pm25 = row.get('value', 0)
-            station_name = row.get('station_name', 'Unknown Station')
-            timestamp = row.get('datetime', 'Unknown Time')
-            popup_content = f"""
-            <div style="font-size: 12px; padding: 5px; width: 200px;">
-                <b>Station: {station_name}</b><br>
-                <b>AQI: {aqi}</b><br>
-                PM2.5: {pm25:.1f} µg/m³<br>
-                {get_alert(aqi)}<br>
-                Lat: {row['lat']:.3f}<br>
-                Lon: {row['lon']:.3f}<br>
-                Time: {timestamp}<br>
-            </div>
-            """
-            folium.CircleMarker(
-                location=[float(row['lat']), float(row['lon'])],
-                radius=6, 
-                color=get_color(aqi), 
-                fill=True, 
-                fillOpacity=0.8,
-                popup=folium.Popup(popup_content, max_width=200)
-            ).add_to(m)
-        # Fit to bbox
-        bounds = [[bbox[1], bbox[0]], [bbox[3], bbox[2]]]
+        _add_station_markers(m, lon, lat, val, aqi, times, names)
         m.fit_bounds(bounds)
         
         return m, legend_html
 
-    # Generate filled contour image with smooth colors
-    fig, ax = plt.subplots(figsize=(10, 10))
     # PM2.5 levels for AQI categories: Good (<12), Moderate (12-35.4), Unhealthy Sensitive (35.5-55.4), Unhealthy (>55.4)
-    max_value = max(np.max(valid_values), 55.4) + 1 if len(valid_values) > 0 else 200
-    levels = [0, 12, 35.4, 55.4, max_value]  # Strictly increasing, finite levels
-    colors = ['green', 'yellow', 'orange', 'red']
-    cmap = ListedColormap(colors)
-    
-    # Filled contours (smooth areas, no boundary lines)
-    cf = ax.contourf(grid_lon, grid_lat, grid_values, levels=levels, cmap=cmap, extend='max', alpha=0.6)
-    
-    # Remove axes, set extent
-    ax.set_xlim(grid_lon.min(), grid_lon.max())
-    ax.set_ylim(grid_lat.min(), grid_lat.max())
-    ax.axis('off')
-    
-    # Save as transparent PNG
-    buf = BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0, transparent=True, dpi=150, facecolor='none')
-    buf.seek(0)
-    img_data = base64.b64encode(buf.read()).decode('utf-8')
-    plt.close(fig)
+    levels = (0, 12, 35.4, 55.4)  # Lower bound of each category
+    img_uri = _render_overlay_png(
+        np.ascontiguousarray(grid_values, dtype=np.float32).tobytes(),
+        grid_values.shape, levels
+    )
     
     # Overlay image on Folium
-    img_bounds = [[grid_lat.min(), grid_lon.min()], [grid_lat.max(), grid_lon.max()]]
+    # Each pixel covers a whole cell centred on its grid node, so the image
+    # extends half a cell past the first and last nodes
+    half = grid_resolution / 2
+    img_bounds = [[float(grid_lat.min()) - half, float(grid_lon.min()) - half],
+                  [float(grid_lat.max()) + half, float(grid_lon.max()) + half]]
     folium.raster_layers.ImageOverlay(
-        image=f'data:image/png;base64,{img_data}',
+        image=img_uri,
         bounds=img_bounds,
         opacity=0.7
     ).add_to(m)
     
-    # Station markers with detailed popups
-    def get_color(aqi):
-        if aqi <= 50: return 'green'
-        elif aqi <= 100: return 'yellow'
-        elif aqi <= 150: return 'orange'
-        else: return 'red'
-
-    def get_alert(aqi):
-        if aqi <= 50:
-            return "🟢 Good: Air quality is satisfactory. No health risks."
-        elif aqi <= 100:
-            return "🟡 Moderate: Air quality acceptable. Sensitive groups may notice minor effects."
-        elif aqi <= 150:
-            return "🟠 Unhealthy for Sensitive: Reduce outdoor activity for children, elderly, and those with respiratory issues."
-        else:
-            return "🔴 Unhealthy: Potential health effects for everyone. Limit outdoor time."
-
-    for _, row in data.iterrows():
-        aqi = row.get('aqi', 0)
-        pm25 = row.get('value', 0)
-        station_name = row.get('station_name', 'Unknown Station')
-        timestamp = row.get('datetime', 'Unknown Time')
-        popup_content = f"""
-        <div style="font-size: 12px; padding: 5px; width: 200px;">
-            <b>Station: {station_name}</b><br>
-            <b>AQI: {aqi}</b><br>
-            PM2.5: {pm25:.1f} µg/m³<br>
-            {get_alert(aqi)}<br>
-            Lat: {row['lat']:.3f}<br>
-            Lon: {row['lon']:.3f}<br>
-            Time: {timestamp}<br>
-        </div>
-        """
-        folium.CircleMarker(
-            location=[float(row['lat']), float(row['lon'])],
-            radius=6, 
-            color=get_color(aqi), 
-            fill=True, 
-            fillOpacity=0.8,
-            popup=folium.Popup(popup_content, max_width=200)
-        ).add_to(m)
-
-    # Fit to bbox
-    bounds = [[bbox[1], bbox[0]], [bbox[3], bbox[2]]]
+    _add_station_markers(m, lon, lat, val, aqi, times, names)
     m.fit_bounds(bounds)
 
     return m, legend_html